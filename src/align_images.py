@@ -3,35 +3,346 @@
 Script para alinhar múltiplas imagens FITS usando reprojeção WCS
 """
 
-import glob
+import functools
+import multiprocessing
+import os
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from astropy.io import fits
 from astropy.wcs import WCS
-from reproject import reproject_interp
-import gc
+from astropy.wcs.utils import pixel_to_pixel
+import reproject.array_utils
 
+import projections
+from io_utils import SCALE_KEYWORDS, read_scaled
 
-def find_fits_files(data_dir):
-    """Encontrar todos os arquivos FITS no diretório"""
-    patterns = ['**/*.fits', '**/*.fit', '**/*.fts']
-    fits_files = []
+try:
+    import cupy as cp
+    import cupyx.scipy.ndimage
+except ImportError:
+    cp = None
 
-    for pattern in patterns:
-        fits_files.extend(glob.glob(str(data_dir / pattern), recursive=True))
+# Cada processo com GPU cria seu próprio contexto CUDA, então limitamos os workers
+MAX_GPU_WORKERS = 4
 
-    return sorted(fits_files)
+# Máximo de imagens do mesmo WCS processadas por tarefa de um worker
+MAX_BATCH_SIZE = 8
 
+# Mapeamentos de pixels mantidos em cache por worker (cada um ocupa 2 × H × W
+# float32, ~110 MB num quadro do ZTF): só o último, reaproveitado pelas imagens
+# seguidas de um mesmo lote
+PIXEL_MAPPING_CACHE_SIZE = 1
 
-def load_fits_image(filepath):
-    """Carregar imagem FITS e seu WCS"""
-    with fits.open(filepath) as hdul:
-        data = hdul[0].data
-        header = hdul[0].header
-        wcs = WCS(header)
+# Valor int16 usado para pixels sem dados (NaN) nas imagens alinhadas
+INT16_BLANK = -32768
+
+# Tamanho do bloco FITS e BITPIX correspondente a cada dtype numpy
+FITS_BLOCK_SIZE = 2880
+BITPIX_BY_DTYPE = {'u1': 8, 'i2': 16, 'i4': 32, 'i8': 64, 'f4': -32, 'f8': -64}
+
+# Palavras-chave do header que definem o WCS (usadas na impressão digital)
+WCS_KEY_PREFIXES = ('CTYPE', 'CUNIT', 'CRVAL', 'CRPIX', 'CDELT', 'CROTA', 'CD1_', 'CD2_', 'PC1_', 'PC2_', 'PV',
+                    'A_', 'B_', 'AP_', 'BP_', 'LONPOLE', 'LATPOLE', 'RADESYS', 'RADECSYS', 'EQUINOX')
+
+
+def load_fits_image(filepath, window=None, with_wcs=True):
+    """
+    Carregar imagem FITS e seu WCS.
+
+    O arquivo é mapeado em memória e só a janela (y0, y1, x0, x1) pedida é
+    lida do disco; o WCS retornado já vem deslocado para essa janela.
+    Com with_wcs=False o WCS não é montado e o retorno é (data, None, header).
+    """
+    with fits.open(filepath, memmap=True, mode='denywrite',
+                   do_not_scale_image_data=True, lazy_load_hdus=True) as hdul:
+        data = read_scaled(hdul[0], window)
+        header = hdul[0].header.copy()
+
+    # Os dados já estão em valores físicos
+    for key in SCALE_KEYWORDS:
+        header.pop(key, None)
+
+    if not with_wcs:
+        return data, None, header
+
+    wcs = WCS(header)
+    if window is not None:
+        y0, y1, x0, x1 = window
+        wcs = wcs.slice((slice(y0, y1), slice(x0, x1)))
     return data, wcs, header
 
 
+def gpu_available():
+    """Verificar se há uma GPU CUDA utilizável via cupy"""
+    if cp is None:
+        return False
+    try:
+        return cp.cuda.runtime.getDeviceCount() > 0
+    except cp.cuda.runtime.CUDARuntimeError:
+        return False
+
+
+def _gpu_map_coordinates(image, coords, output=None, max_chunk_size=None, **kwargs):
+    """Substituto de reproject.array_utils.map_coordinates que interpola na GPU"""
+    image_gpu = cp.asarray(image, dtype=cp.float64)
+    coords_gpu = cp.asarray(coords, dtype=cp.float64)
+
+    # Assim como no reproject, pixels na metade externa das bordas usam o valor
+    # do pixel da borda em vez de virarem NaN
+    for axis, size in enumerate(image.shape):
+        c = coords_gpu[axis]
+        c[(c < 0) & (c >= -0.5)] = 0
+        c[(c > size - 1) & (c <= size - 0.5)] = size - 1
+
+    values = cupyx.scipy.ndimage.map_coordinates(
+        image_gpu,
+        coords_gpu,
+        order=kwargs.get('order', 1),
+        mode=kwargs.get('mode', 'constant'),
+        cval=kwargs.get('cval', np.nan)
+    )
+
+    # Coordenadas fora da imagem não são interpoladas
+    outside = cp.zeros(values.shape, dtype=bool)
+    for axis, size in enumerate(image.shape):
+        outside |= (coords_gpu[axis] < -0.5) | (coords_gpu[axis] > size - 0.5)
+    values[outside] = kwargs.get('cval', np.nan)
+
+    if output is None:
+        return cp.asnumpy(values)
+    output[...] = cp.asnumpy(values)
+    return output
+
+
+def enable_gpu_backend():
+    """Trocar a interpolação do reproject pela versão em GPU, se houver CUDA"""
+    if not gpu_available():
+        return False
+
+    reproject.array_utils.map_coordinates = _gpu_map_coordinates
+    return True
+
+
+@functools.lru_cache(maxsize=PIXEL_MAPPING_CACHE_SIZE)
+def compute_pixel_mapping(src_header_str, tgt_header_str, shape):
+    """
+    Calcular, para cada pixel da grade de destino, a posição correspondente
+    na imagem de origem.
+
+    Returns:
+        (coords, footprint, window): coords no formato (2, H*W) [y, x] aceito
+        por reproject.array_utils.map_coordinates, relativas à janela (y0, y1, x0, x1) da origem que
+        cobre a grade de destino, e footprint com 1 onde o pixel cai na origem
+    """
+    src_header = fits.Header.fromstring(src_header_str)
+    src_wcs = WCS(src_header).celestial
+    tgt_wcs = WCS(fits.Header.fromstring(tgt_header_str)).celestial
+
+    y_out, x_out = np.indices(shape, dtype=float)
+    if projections.is_pure_tan(src_wcs) and projections.is_pure_tan(tgt_wcs):
+        # Caso TAN puro: projeção gnomônica vetorizada em NumPy, sem WCSLIB
+        ra, dec = projections.manual_pix_to_world_tan(
+            x_out, y_out, *projections.tan_parameters(tgt_wcs)
+        )
+        x_in, y_in = projections.manual_world_to_pix_tan(
+            ra, dec, *projections.tan_parameters(src_wcs)
+        )
+        del ra, dec
+    else:
+        x_in, y_in = pixel_to_pixel(tgt_wcs, src_wcs, x_out, y_out)
+    del x_out, y_out
+
+    src_shape = (src_header['NAXIS2'], src_header['NAXIS1'])
+    footprint = (
+        (x_in >= -0.5) & (x_in <= src_shape[1] - 0.5) &
+        (y_in >= -0.5) & (y_in <= src_shape[0] - 0.5)
+    ).astype(np.float32)
+
+    # Só a região da origem que projeta na grade de destino precisa ser lida
+    # (com 1 pixel de margem para a interpolação bilinear)
+    covered = footprint > 0
+    if covered.any():
+        y0 = max(int(np.floor(y_in[covered].min())) - 1, 0)
+        y1 = min(int(np.ceil(y_in[covered].max())) + 2, src_shape[0])
+        x0 = max(int(np.floor(x_in[covered].min())) - 1, 0)
+        x1 = min(int(np.ceil(x_in[covered].max())) + 2, src_shape[1])
+    else:
+        y0, y1, x0, x1 = 0, 1, 0, 1
+
+    coords = np.array([y_in.ravel() - y0, x_in.ravel() - x0], dtype=np.float32)
+    return coords, footprint, (y0, y1, x0, x1)
+
+
+def quantize_int16(data, header):
+    """
+    Quantizar uma imagem float para int16 com BSCALE/BZERO, atualizando o header.
+
+    NaNs viram BLANK; na leitura com escala (CCDData.read, fits.open) o astropy
+    devolve os valores físicos e BLANK volta a ser NaN.
+    """
+    finite = np.isfinite(data)
+    if finite.any():
+        vmin = float(data[finite].min())
+        vmax = float(data[finite].max())
+    else:
+        vmin = vmax = 0.0
+
+    # Valores válidos ocupam [-32500, 32500]; -32768 fica reservado para BLANK
+    bscale = (vmax - vmin) / 65000. if vmax > vmin else 1.0
+    bzero = vmin + bscale * 32500
+
+    quantized = np.full(data.shape, INT16_BLANK, dtype=np.int16)
+    quantized[finite] = np.round((data[finite] - bzero) / bscale)
+
+    header['BITPIX'] = 16
+    header['BSCALE'] = bscale
+    header['BZERO'] = bzero
+    header['BLANK'] = INT16_BLANK
+    return quantized
+
+
+def fast_writeto(path, data, header):
+    """
+    Gravar uma imagem como HDU primária escrevendo os bytes diretamente
+    (header em blocos de 2880 + dados big-endian), sem montar a HDU no astropy.
+
+    Se o header não começar com SIMPLE/BITPIX/NAXIS usa fits.writeto.
+    """
+    keys = list(header.keys())
+    if keys[:3] != ['SIMPLE', 'BITPIX', 'NAXIS'] or data.dtype.str[1:] not in BITPIX_BY_DTYPE:
+        # O astropy descarta BSCALE/BZERO/BLANK do header ao criar a HDU com
+        # dados já quantizados, então eles são recolocados depois
+        hdu = fits.PrimaryHDU(data=data, header=header)
+        for key in SCALE_KEYWORDS:
+            if key in header:
+                hdu.header[key] = header[key]
+        hdu.writeto(path, overwrite=True)
+        return
+
+    header['BITPIX'] = BITPIX_BY_DTYPE[data.dtype.str[1:]]
+    header['NAXIS'] = data.ndim
+    for axis, size in enumerate(reversed(data.shape), start=1):
+        header[f'NAXIS{axis}'] = size
+
+    with open(path, 'wb') as f:
+        f.write(header.tostring(padding=True).encode('ascii'))
+        data.astype(data.dtype.newbyteorder('>'), copy=False).tofile(f)
+
+        # Completar o último bloco de dados com zeros
+        remainder = data.nbytes % FITS_BLOCK_SIZE
+        if remainder:
+            f.write(b'\0' * (FITS_BLOCK_SIZE - remainder))
+
+
+def wcs_fingerprint(header):
+    """Impressão digital do WCS e da geometria de um header, usada para agrupar imagens"""
+    keys = []
+    for key, value in header.items():
+        if key.startswith(WCS_KEY_PREFIXES) or key in ('NAXIS1', 'NAXIS2'):
+            if isinstance(value, float):
+                value = float(f"{value:.10g}")
+            keys.append((key, value))
+    return tuple(sorted(keys))
+
+
+def group_by_wcs(fits_files):
+    """Agrupar (índice, arquivo) por (WCS, filtro) lendo só os headers"""
+    groups = {}
+    failed = []
+
+    for i, fits_file in enumerate(fits_files, start=1):
+        try:
+            header = fits.getheader(fits_file)
+            key = (wcs_fingerprint(header), header['FILTER'])
+        except Exception as e:
+            failed.append((i, Path(fits_file).name, e))
+            continue
+        groups.setdefault(key, []).append((i, fits_file))
+
+    # Lotes limitados para manter a memória de cada worker sob controle
+    batches = []
+    for (fingerprint, filter_type), members in groups.items():
+        # Header só com as palavras-chave do WCS: é a chave do cache de mapeamentos
+        wcs_header_str = fits.Header(list(fingerprint)).tostring()
+        for start in range(0, len(members), MAX_BATCH_SIZE):
+            batches.append((filter_type, wcs_header_str, members[start:start + MAX_BATCH_SIZE]))
+
+    return batches, failed
+
+
+def _align_batch(args):
+    """Reprojetar um lote de imagens com o mesmo WCS (executa em um worker)"""
+    batch, wcs_header_str, ref_header_str, ref_shape, filter_dir = args
+    results = []
+
+    ref_header = fits.Header.fromstring(ref_header_str)
+
+    try:
+        # O mapeamento de pixels depende só dos dois WCS: é calculado uma vez
+        # e reaproveitado por todas as imagens do lote (e lotes seguintes)
+        coords, footprint, window = compute_pixel_mapping(wcs_header_str, ref_header_str, tuple(ref_shape))
+    except Exception as e:
+        return [(i, Path(fits_file).name, None, None, None, e) for i, fits_file in batch]
+
+    coverage = (np.sum(footprint) / footprint.size) * 100
+
+    # A gravação roda numa thread separada e se sobrepõe à próxima interpolação
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending = []
+
+    # Buffer de saída reaproveitado por todas as imagens do lote: a quantização
+    # gera um array novo, então ele pode ser sobrescrito enquanto a gravação anterior roda
+    aligned = np.empty(ref_shape, dtype=np.float32)
+    no_coverage = footprint == 0
+
+    for i, fits_file in batch:
+        filename = Path(fits_file).name
+        try:
+            # Carregar só a janela da imagem que cobre a referência
+            data, _, header = load_fits_image(fits_file, window=window, with_wcs=False)
+
+            # Interpolação bilinear direto sobre o mapeamento em cache
+            reproject.array_utils.map_coordinates(
+                data,
+                coords,
+                order=1,
+                cval=np.nan,
+                mode='constant',
+                output=aligned.ravel()
+            )
+            aligned[no_coverage] = np.nan
+            n_nans = int(np.sum(np.isnan(aligned)))
+
+            output_file = filter_dir / f"{i}_aligned_{filename}"
+
+            # Atualizar header com informações
+            new_header = ref_header.copy()
+            new_header['DATE-OBS'] = header.get('DATE-OBS', '')
+            new_header['EXPTIME'] = header.get('EXPTIME', '')
+            new_header['FILTER'] = header.get('FILTER', '')
+
+            # Gravar em int16 com BSCALE/BZERO (formato nativo do ZTF): metade dos bytes
+            quantized = quantize_int16(aligned, new_header)
+            future = writer.submit(fast_writeto, output_file, quantized, new_header)
+        except Exception as e:
+            results.append((i, filename, None, None, None, e))
+            continue
+        pending.append((i, filename, output_file, n_nans, future))
+
+    # Aguardar as gravações pendentes antes de reportar o lote
+    for i, filename, output_file, n_nans, future in pending:
+        try:
+            future.result()
+        except Exception as e:
+            results.append((i, filename, None, None, None, e))
+            continue
+        results.append((i, filename, output_file, coverage, n_nans, None))
+    writer.shutdown()
+
+    return results
+
+
 def process(fits_files):
     # Diretórios
     project_root = Path(__file__).parent.parent
@@ -53,6 +364,10 @@ def process(fits_files):
     print(f"{'='*60}")
     print(f"Total de imagens: {len(fits_files)}")
 
+    # Interpolação na GPU quando houver CUDA; caso contrário segue na CPU
+    use_gpu = gpu_available()
+    print(f"Backend de interpolação: {'GPU (cupy)' if use_gpu else 'CPU (scipy)'}")
+
     # Criar diretório de saída
     output_dir.mkdir(exist_ok=True, parents=True)
     red_filter_dir.mkdir(exist_ok=True, parents=True)
@@ -73,76 +388,55 @@ def process(fits_files):
     fits.writeto(ref_output, ref_data, ref_header, overwrite=True)
     print(f"   ✓ Salva em: {ref_output}")
 
-    # Limpar referência da memória após salvar (não precisamos manter em memória)
-    del ref_data
-
     # Reprojetar todas as outras imagens
     print(f"\n{'='*60}")
     print("REPROJETANDO IMAGENS...")
     print(f"{'='*60}")
 
-    for i, fits_file in enumerate(fits_files[1:], start=1):
-        filename = Path(fits_file).name
-        print(f"\n[{i}/{len(fits_files)-1}] {filename}")
-
-        try:
-            # Carregar imagem
-            data, wcs, header = load_fits_image(fits_file)
-            print(f"   Dimensões originais: {data.shape}")
-
-            # Reprojetar para o WCS de referência
-            print(f"   Reprojetando...", end=" ")
-            aligned, footprint = reproject_interp(
-                (data, wcs),
-                ref_wcs,
-                shape_out=ref_shape
-            )
-            print("✓")
-
-            # Calcular estatísticas
-            valid_pixels = np.sum(footprint)
-            total_pixels = footprint.size
-            coverage = (valid_pixels / total_pixels) * 100
+    ref_header_str = ref_header.tostring()
 
-            print(f"   Cobertura: {coverage:.1f}% ({valid_pixels}/{total_pixels} pixels)")
-            print(f"   NaNs: {np.sum(np.isnan(aligned))}")
+    # Imagens do mesmo campo/filtro com WCS idêntico compartilham o mapeamento de pixels
+    batches, failed = group_by_wcs(fits_files[1:])
+    print(f"Lotes com WCS compartilhado: {len(batches)}")
 
-            # Salvar imagem alinhada
-            filter_type = header['FILTER']
-            print(f"Filter type: {filter_type}")
-            filter_dir = filter_type_to_dir[filter_type]
-
-
-            output_file = filter_dir / f"{i}_aligned_{filename}"
-
-            # Atualizar header com informações
-            new_header = ref_header.copy()
-            new_header['DATE-OBS'] = header.get('DATE-OBS', '')
-            new_header['EXPTIME'] = header.get('EXPTIME', '')
-            new_header['FILTER'] = header.get('FILTER', '')
-
-            print('BUNIT: ', new_header['BUNIT'])
-
-            fits.writeto(output_file, aligned, new_header, overwrite=True)
-            print(f"   ✓ Salva em: {output_file}")
-
-            # Limpar dados da memória após salvar
-            del data, aligned, footprint, wcs, header, new_header
-
-            # Forçar garbage collection a cada 10 imagens para liberar memória
-            if i % 10 == 0:
-                gc.collect()
-
-        except Exception as e:
-            print(f"   ❌ ERRO: {e}")
-            # Garantir limpeza mesmo em caso de erro
-            if 'data' in locals():
-                del data
-            if 'aligned' in locals():
-                del aligned
-            if 'footprint' in locals():
-                del footprint
+    for i, filename, error in failed:
+        print(f"\n[{i}/{len(fits_files)-1}] {filename}")
+        print(f"   ❌ ERRO: {error}")
+
+    args_list = []
+    for filter_type, wcs_header_str, batch in batches:
+        if filter_type not in filter_type_to_dir:
+            for i, fits_file in batch:
+                print(f"\n[{i}/{len(fits_files)-1}] {Path(fits_file).name}")
+                print(f"   ❌ ERRO: filtro desconhecido {filter_type!r}")
             continue
+        args_list.append((batch, wcs_header_str, ref_header_str, ref_shape, filter_type_to_dir[filter_type]))
+
+    # Cada worker reprojeta um lote; o WCS de referência é reconstruído
+    # a partir do header serializado para não precisar picklear o objeto WCS
+    if use_gpu:
+        # CUDA não sobrevive a fork: os workers são criados com spawn e
+        # aplicam o backend de GPU no initializer
+        pool = ProcessPoolExecutor(
+            max_workers=min(os.cpu_count(), MAX_GPU_WORKERS),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=enable_gpu_backend
+        )
+    else:
+        pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+    with pool as executor:
+        for results in executor.map(_align_batch, args_list, chunksize=1):
+            for i, filename, output_file, coverage, n_nans, error in results:
+                print(f"\n[{i}/{len(fits_files)-1}] {filename}")
+
+                if error is not None:
+                    print(f"   ❌ ERRO: {error}")
+                    continue
+
+                print(f"   Cobertura: {coverage:.1f}%")
+                print(f"   NaNs: {n_nans}")
+                print(f"   ✓ Salva em: {output_file}")
 
     print(f"\n{'='*60}")
     print(f"✓ Alinhamento completo!")
@@ -1,15 +1,71 @@
-from ccdproc import CCDData, Combiner
+from astropy.nddata import CCDData
+from astropy.io import fits
+from astropy.wcs import WCS
 import astropy.units as u
+import numpy as np
+from io_utils import SCALE_KEYWORDS, read_scaled
+from contextlib import ExitStack
 from pathlib import Path
-import gc
 
-def process(files_dir, max_images=None):
+# Linhas lidas de cada imagem por vez quando não é dado um tile: a pilha em
+# memória tem N × ROW_BAND × W pixels, em vez de N imagens inteiras
+ROW_BAND = 256
+
+# Sigma clipping em torno da mediana, com desvio estimado pelo MAD
+CLIP_SIGMA = 3
+MAD_TO_SIGMA = 1.4826
+
+
+def nanmedian_partition(stack):
+    """
+    Mediana ao longo do eixo 0 ignorando NaN, usando np.partition (seleção
+    O(N)) em vez da ordenação completa de cada coluna feita por np.nanmedian.
+    """
+    n = stack.shape[0]
+    counts = np.isfinite(stack).sum(axis=0)
+
+    if counts.min() == n:
+        # Sem NaN: basta posicionar os dois elementos centrais
+        lo, hi = (n - 1) // 2, n // 2
+        part = np.partition(stack, sorted({lo, hi}), axis=0)
+        return 0.5 * (part[lo] + part[hi])
+
+    # np.partition manda os NaN para o fim, então os k valores finitos de cada
+    # pixel ocupam as posições [0, k); a mediana fica em (k-1)//2 e k//2
+    part = np.partition(stack, list(range(n // 2 + 1)), axis=0)
+    lo = np.maximum((counts - 1) // 2, 0)
+    hi = counts // 2
+    median = 0.5 * (
+        np.take_along_axis(part, lo[np.newaxis], axis=0)[0] +
+        np.take_along_axis(part, hi[np.newaxis], axis=0)[0]
+    )
+    median[counts == 0] = np.nan
+    return median
+
+
+def clipped_median(stack):
+    """Mediana com uma rodada de sigma clipping (MAD) em torno da mediana inicial"""
+    median = nanmedian_partition(stack)
+
+    deviation = np.abs(stack - median)
+    sigma = MAD_TO_SIGMA * nanmedian_partition(deviation)
+    stack[deviation > CLIP_SIGMA * sigma] = np.nan
+
+    return nanmedian_partition(stack)
+
+
+def process(files_dir, max_images=None, files=None, tile=None, out=None):
     """
     Combina imagens FITS de um diretório específico usando median combine.
 
     Args:
         files_dir: Diretório contendo as imagens FITS a serem combinadas
         max_images: Número máximo de imagens a carregar (None para todas)
+        files: Lista de arquivos a combinar (None para todos os FITS de files_dir)
+        tile: Bloco (altura, largura) lido de cada imagem por vez (None para
+            faixas de ROW_BAND linhas com a largura inteira)
+        out: Array float32 com o shape da imagem onde gravar a mediana (None
+            para alocar um novo)
 
     Returns:
         CCDData: Imagem combinada usando median
@@ -20,7 +76,10 @@ def process(files_dir, max_images=None):
     files_dir = Path(files_dir)
 
     # Find all FITS files
-    fits_files = sorted(files_dir.glob('*.fits'))
+    if files is None:
+        fits_files = sorted(files_dir.glob('*.fits'))
+    else:
+        fits_files = [Path(f) for f in files]
 
     if len(fits_files) == 0:
         raise ValueError(f"No FITS files found in {files_dir}")
@@ -32,25 +91,41 @@ def process(files_dir, max_images=None):
         fits_files = fits_files[:max_images]
         print(f"Limiting to {max_images} images")
 
-    # Load all FITS files as CCDData objects
-    # Pass unit='adu' to handle invalid BUNIT header values like "Data Value"
-    # ADU (Analog-to-Digital Units) is the standard unit for CCD data
-    ccd_list = []
-    for fits_file in fits_files:
-        ccd = CCDData.read(fits_file, unit=u.adu)
-        ccd_list.append(ccd)
-        print(f"  ✓ Loaded {fits_file.name}")
-
-    c = Combiner(ccd_list)
-    print(f"\nUsing sigma-clipped median...")
-    c.sigma_clipping()
-
-    print(f"\nCombining {len(ccd_list)} images using median...")
-    median_combined = c.median_combine()
-    print("✓ Combination complete")
+    print(f"\nCombining {len(fits_files)} images using sigma-clipped median...")
+
+    with ExitStack() as stack:
+        # Arquivos mapeados em memória: só as faixas de linhas lidas vão para a RAM
+        hdus = [
+            stack.enter_context(fits.open(f, memmap=True, do_not_scale_image_data=True))[0]
+            for f in fits_files
+        ]
+
+        shape = hdus[0].shape
+        for f, hdu in zip(fits_files, hdus):
+            if hdu.shape != shape:
+                raise ValueError(f"{f.name} has shape {hdu.shape}, expected {shape}")
 
-    # Limpar lista de imagens da memória após combinação
-    del ccd_list, c
-    gc.collect()
+        header = hdus[0].header.copy()
+        for key in SCALE_KEYWORDS:
+            header.pop(key, None)
+
+        height, width = shape
+        median = np.empty(shape, dtype=np.float32) if out is None else out
+
+        # A pilha em memória tem N × tile pixels
+        tile_height, tile_width = (ROW_BAND, width) if tile is None else tile
+        for y0 in range(0, height, tile_height):
+            y1 = min(y0 + tile_height, height)
+            for x0 in range(0, width, tile_width):
+                x1 = min(x0 + tile_width, width)
+                band = np.stack([read_scaled(hdu, (y0, y1, x0, x1)) for hdu in hdus])
+                median[y0:y1, x0:x1] = clipped_median(band)
+
+    wcs = WCS(header)
+
+    # ADU (Analog-to-Digital Units) is the standard unit for CCD data; the
+    # BUNIT header value (e.g. "Data Value") is not a valid unit
+    median_combined = CCDData(median, unit=u.adu, meta=header, wcs=wcs)
+    print("✓ Combination complete")
 
     return median_combined
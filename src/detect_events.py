@@ -1,9 +1,26 @@
-import astropy.stats as s
+import os
 from scipy import ndimage
 import numpy as np
 import astropy.wcs as wcs
 from astropy.io import fits
-import gc
+from astropy.stats import sigma_clipped_stats
+from numba import njit, prange
+
+# fastmath sem 'nnan'/'ninf' (nem 'nsz', que junto com 'reassoc' faz o LLVM
+# eliminar o np.isfinite): os kernels dependem de NaN para ignorar pixels sem cobertura
+FASTMATH_FLAGS = {'arcp', 'contract', 'afn', 'reassoc'}
+
+# Parâmetros do sigma clipping de --exact (astropy.stats.sigma_clipped_stats)
+CLIP_SIGMA = 3.0
+CLIP_MAXITERS = 5
+
+# Gravar a imagem diferença de cada chamada (só para depuração: ~100 MB por imagem)
+DEBUG_WRITE_DIFF = False
+_debug_diff_count = 0
+
+# Estimativa rápida do ruído: MAD sobre uma amostra aleatória de pixels
+MAD_SAMPLE_SIZE = 200_000
+MAD_TO_SIGMA = 1.4826
 
 
 #multi line comment
@@ -37,31 +54,119 @@ import gc
 10. Ordenar por SNR (melhores primeiro)
 """
 
-def process(reference_image, science_image):
+@njit(parallel=True, fastmath=FASTMATH_FLAGS, cache=True)
+def _difference(science, reference, out):
+    """Gravar science - reference em out e contar os pixels finitos"""
+    count = 0
+    for y in prange(science.shape[0]):
+        for x in range(science.shape[1]):
+            d = science[y, x] - reference[y, x]
+            out[y, x] = d
+            if np.isfinite(d):
+                count += 1
+    return count
+
+
+@njit(parallel=True, fastmath=FASTMATH_FLAGS, cache=True)
+def _threshold_mask(difference, threshold, out_mask):
+    """Marcar em out_mask os pixels com |difference| > threshold (NaN fica False)"""
+    for y in prange(difference.shape[0]):
+        for x in range(difference.shape[1]):
+            out_mask[y, x] = abs(difference[y, x]) > threshold
+
+
+def _native(array):
+    """Numba não aceita arrays big-endian (padrão do FITS): converter se preciso"""
+    if array.dtype.isnative:
+        return array
+    return array.astype(array.dtype.newbyteorder('='))
+
+
+def subsample_mad_stats(difference):
+    """
+    Estimar centro (mediana) e desvio (MAD × 1.4826) da diferença a partir
+    de uma amostra aleatória de pixels, em vez de iterar sobre a imagem toda.
+    """
+    rng = np.random.default_rng(0)
+    flat = difference.ravel()
+    sample = flat[rng.integers(0, flat.size, size=min(MAD_SAMPLE_SIZE, flat.size))]
+    sample = sample[np.isfinite(sample)]
+
+    # Imagem quase toda sem cobertura: a amostra pode não ter pixels válidos
+    if sample.size == 0:
+        sample = flat[np.isfinite(flat)]
+
+    median = np.median(sample)
+    deviation = MAD_TO_SIGMA * np.median(np.abs(sample - median))
+    return median, deviation
+
+
+def difference_stats(science_data, reference_data, exact=False):
+    """
+    Calcular a imagem diferença, seu centro e seu desvio.
+
+    A diferença é calculada num único kernel paralelo. Por padrão o desvio
+    vem do MAD de uma amostra (subsample_mad_stats); com exact=True vem do
+    astropy.stats.sigma_clipped_stats sobre todos os pixels finitos, como antes.
+    """
+    # O kernel não confere limites: shapes diferentes leriam fora da referência
+    if science_data.shape != reference_data.shape:
+        raise ValueError(
+            f"science shape {science_data.shape} does not match reference shape {reference_data.shape}"
+        )
+
+    science_data = _native(science_data)
+    reference_data = _native(reference_data)
+
+    # Buffer float32: metade da memória (e da banda) de um float64
+    difference = np.empty(science_data.shape, dtype=np.float32)
+    count = _difference(science_data, reference_data, difference)
+    if count == 0:
+        return difference, None, None
+
+    if not exact:
+        median, deviation = subsample_mad_stats(difference)
+        return difference, median, deviation
+
+    _, median, deviation = sigma_clipped_stats(
+        difference[np.isfinite(difference)], sigma=CLIP_SIGMA, maxiters=CLIP_MAXITERS
+    )
+    return difference, median, deviation
+
+
+def process(reference_image, science_image, exact_stats=False, science_wcs=None, max_candidates=None):
     THRESHOLD_MULTIPLIER = 5
     MIN_AREA = 10
     MIN_SNR = 10
     BORDER_SIZE = 100
 
-    science_wcs = wcs.WCS(science_image.header)
+    # O WCS pode vir pronto de quem chama (ex.: cache em main.load_science) ou
+    # já fixado na imagem; só em último caso é reconstruído a partir do header
+    if science_wcs is None:
+        science_wcs = science_image.wcs if science_image.wcs is not None else wcs.WCS(science_image.header)
 
     reference_image_data = reference_image.data
     science_image_data = science_image.data
 
-    difference = science_image_data - reference_image_data
-
-    # wrute the difference image to a fits file
-    fits.writeto("difference.fits", difference, science_image.header, overwrite=True)
-
-    # Filtrar NaNs antes de calcular estatísticas
-    valid_difference = difference[~np.isnan(difference)]
-    if len(valid_difference) == 0:
+    # Diferença e estatísticas num kernel paralelo (numba); o desvio vem do
+    # MAD de uma amostra, ou de sigma clipping completo se exact_stats=True
+    difference, center, deviation = difference_stats(
+        science_image_data, reference_image_data, exact=exact_stats
+    )
+
+    # wrute the difference image to a fits file (debug only)
+    if DEBUG_WRITE_DIFF:
+        global _debug_diff_count
+        # O contador é por processo: o pid evita que workers diferentes sobrescrevam o mesmo arquivo
+        fits.writeto(f"/tmp/diff_{os.getpid()}_{_debug_diff_count}.fits", difference, science_image.header,
+                     overwrite=True)
+        _debug_diff_count += 1
+
+    if center is None:
         print("Error: All pixels are NaN in difference image")
         return []
 
-    mean, median, deviation = s.sigma_clipped_stats(valid_difference)
-
-    print(f"Mean: {mean}, Median: {median}, Deviation: {deviation}")
+    print(f"Center: {center}, Deviation: {deviation}")
 
     # limit for the difference
     threshold = deviation * THRESHOLD_MULTIPLIER
@@ -69,78 +174,79 @@ def process(reference_image, science_image):
     print(f"Threshold: {threshold}")
 
 
-    positive_mask = difference > threshold
-    negative_mask = difference < -threshold
-    significant_mask = positive_mask | negative_mask
+    significant_mask = np.empty(difference.shape, dtype=np.bool_)
+    _threshold_mask(difference, threshold, significant_mask)
 
     # breaking the significant_mask into groups so we can compare them separately (each group is a potential event)
     labeled_mask, num_features = ndimage.label(significant_mask)
 
+    # Todas as reduções por grupo são feitas de uma vez (uma passada em C
+    # sobre a imagem rotulada) em vez de um laço que varre a imagem por grupo
+    index = np.arange(1, num_features + 1)
+    valid_pixels = np.isfinite(difference)
+
+    areas = np.bincount(labeled_mask.ravel(), minlength=num_features + 1)[1:]
+
+    # Só pixels válidos (não NaN) entram na área válida e no fluxo, porque
+    # imagens reprojetadas podem ter NaN fora da área de cobertura original
+    valid_areas = ndimage.sum_labels(valid_pixels, labeled_mask, index=index)
+
+    # flux is how mutch the event data changed compared to the reference data
+    fluxes = ndimage.sum_labels(np.where(valid_pixels, difference, 0), labeled_mask, index=index)
+
+    # calculating the centroid of the possible events
+    centroids = np.array(ndimage.center_of_mass(significant_mask, labeled_mask, index=index)).reshape(-1, 2)
+
+    # Ruído: desvio padrão global já calculado; SNR considera a área
+    noise = deviation
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snrs = fluxes / (noise * np.sqrt(valid_areas))
+
+    # Filtros aplicados como máscaras booleanas sobre todos os grupos
+    big_enough = (areas >= MIN_AREA) & (valid_areas >= MIN_AREA)
+    finite = np.isfinite(fluxes) & np.isfinite(snrs)
+    significant = finite & (snrs >= MIN_SNR)
+    # not in the border
+    inside = (
+        (centroids[:, 0] >= BORDER_SIZE) & (centroids[:, 0] <= reference_image_data.shape[0] - BORDER_SIZE) &
+        (centroids[:, 1] >= BORDER_SIZE) & (centroids[:, 1] <= reference_image_data.shape[1] - BORDER_SIZE)
+    )
+    accepted = big_enough & significant & inside
+
+    # Limite de eventos por imagem: ficam os max_candidates de maior SNR
+    capped = 0
+    if max_candidates is not None and np.count_nonzero(accepted) > max_candidates:
+        candidates = np.flatnonzero(accepted)
+        keep = candidates[np.argpartition(-snrs[candidates], max_candidates - 1)[:max_candidates]]
+        capped = candidates.size - max_candidates
+        accepted = np.zeros_like(accepted)
+        accepted[keep] = True
+
+    print(f"Features: {num_features}, "
+          f"skipped by area: {np.sum(~big_enough)}, "
+          f"invalid flux/SNR: {np.sum(big_enough & ~finite)}, "
+          f"low SNR: {np.sum(big_enough & finite & ~significant)}, "
+          f"in the border: {np.sum(big_enough & significant & ~inside)}, "
+          f"dropped by the cap: {capped}")
+
+    # converting the centroids to ra and dec
+    rows = centroids[accepted, 0]
+    cols = centroids[accepted, 1]
+    ras, decs = science_wcs.pixel_to_world_values(cols, rows)
+
+    # it's a event
     events = []
-    for i in range(1, num_features + 1):
-        feature_mask = labeled_mask == i
-        area = np.sum(feature_mask)
-
-        if area < MIN_AREA:
-            continue
-
-        # calculating the centroid of the possible event
-        centroid = ndimage.center_of_mass(feature_mask)
-
-        # Create a valid mask that excludes NaN values in difference
-        # This is important because reprojected images may have NaN pixels
-        # outside the original coverage area
-        valid_mask = feature_mask & ~np.isnan(difference)
-
-        # Check if we have any valid pixels
-        valid_area = np.sum(valid_mask)
-        if valid_area < MIN_AREA:
-            print(f"Skipping feature {i}: not enough valid pixels ({valid_area} < {MIN_AREA})")
-            continue
-
-        # flux is how mutch the event data changed compared to the reference data
-        # Only sum over valid (non-NaN) pixels
-        flux = np.sum(difference[valid_mask])
-        print(f"Flux: {flux}")
-
-        # Check for NaN or invalid flux
-        if np.isnan(flux) or np.isinf(flux):
-            print(f"Skipping feature {i}: invalid flux ({flux})")
-            continue
-
-        # Calcular o ruído como o desvio padrão dos pixels válidos na região do evento
-        # ou usar o desvio padrão global já calculado
-        noise = deviation  # ou np.std(difference[valid_mask])
-        snr = flux / (noise * np.sqrt(valid_area))  # SNR considerando a área
-
-        # Check for NaN or invalid SNR
-        if np.isnan(snr) or np.isinf(snr):
-            print(f"Skipping feature {i}: invalid SNR ({snr})")
-            continue
-
-        print(f"SNR: {snr}")
-
-        if snr < MIN_SNR:
-            print(f"Skipping feature {i}: SNR is too low ({snr} < {MIN_SNR})")
-            continue
-
-        # not in the border
-        if centroid[0] < BORDER_SIZE or centroid[0] > reference_image_data.shape[0] - BORDER_SIZE or centroid[1] < BORDER_SIZE or centroid[1] > reference_image_data.shape[1] - BORDER_SIZE:
-            print(f"Skipping feature {i}: centroid is in the border ({centroid})")
-            continue
-
-        # converting the centroid to ra and dec
-        ra, dec = science_wcs.pixel_to_world_values(centroid[1], centroid[0])
-
-        # it's a event
-        print(f"Event found at {centroid} with flux {flux} and SNR {snr}")
+    for row, col, flux, snr, ra, dec, valid_area in zip(
+        rows, cols, fluxes[accepted], snrs[accepted], np.atleast_1d(ras), np.atleast_1d(decs), valid_areas[accepted]
+    ):
+        print(f"Event found at {(row, col)} with flux {flux} and SNR {snr}")
         events.append({
-            "centroid": centroid,
+            "centroid": (row, col),
             "flux": flux,
             "snr": snr,
             "ra": ra,
             "dec": dec,
-            "area": valid_area
+            "area": int(valid_area)
         })
 
     print(f"Found {len(events)} events")
@@ -148,7 +254,4 @@ def process(reference_image, science_image):
     # Ordenar eventos por SNR (maior primeiro)
     events.sort(key=lambda x: x['snr'], reverse=True)
 
-    # Limpar arrays grandes da memória
-    del difference, valid_difference, significant_mask, labeled_mask, feature_mask, valid_mask
-
     return events
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""
+Funções de leitura de arquivos FITS compartilhadas pelo alinhamento, pela
+combinação e pela detecção
+"""
+
+import os
+import re
+import numpy as np
+
+# Extensões reconhecidas como arquivos FITS (.fits, .fit, .fts, em qualquer caixa)
+FITS_NAME_PATTERN = re.compile(r'\.f(its|it|ts)$', re.IGNORECASE)
+
+# Palavras-chave de escala dos dados inteiros
+SCALE_KEYWORDS = ('BSCALE', 'BZERO', 'BLANK')
+
+
+def find_fits_files(data_dir):
+    """Encontrar todos os arquivos FITS no diretório"""
+    # Uma única passada com os.scandir, usando uma pilha em vez de recursão
+    fits_files = []
+    stack = [str(data_dir)]
+    while stack:
+        # Diretórios inexistentes ou ilegíveis são ignorados, como no os.walk
+        # (um data_dir ausente resulta numa lista vazia)
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif FITS_NAME_PATTERN.search(entry.name):
+                        fits_files.append(entry.path)
+        except OSError:
+            continue
+
+    # Ordenados pelo caminho: a primeira imagem é usada como referência
+    fits_files.sort()
+    return fits_files
+
+
+def read_scaled(hdu, window=None):
+    """
+    Ler os dados de uma HDU aberta com do_not_scale_image_data=True como
+    float32, aplicando BSCALE/BZERO/BLANK só sobre a janela (y0, y1, x0, x1).
+
+    Com memmap, só as páginas da janela são lidas do disco (o astropy se
+    recusa a mapear em memória imagens com escala se ele mesmo for aplicá-la).
+    """
+    raw = hdu.data
+    if window is not None:
+        y0, y1, x0, x1 = window
+        raw = raw[y0:y1, x0:x1]
+
+    data = np.array(raw, dtype=np.float32)
+    blank = hdu.header.get('BLANK')
+    if blank is not None and np.issubdtype(raw.dtype, np.integer):
+        data[raw == blank] = np.nan
+    bscale = hdu.header.get('BSCALE', 1)
+    bzero = hdu.header.get('BZERO', 0)
+    if bscale != 1:
+        data *= bscale
+    if bzero != 0:
+        data += bzero
+    return data
@@ -1,35 +1,188 @@
 import align_images
 import combine_images
 import detect_events
-import glob
+import io_utils
+import argparse
+import collections
+import io
+import logging
+import os
+import tempfile
 from pathlib import Path
 from ccdproc import CCDData
 import astropy.units as u
+import numba
+import numpy as np
 from astropy.io import fits
 from astropy.wcs import WCS
-import gc
-
-def find_fits_files(data_dir):
-    """Encontrar todos os arquivos FITS no diretório"""
-    patterns = ['**/*.fits', '**/*.fit', '**/*.fts']
-    fits_files = []
-
-    for pattern in patterns:
-        fits_files.extend(glob.glob(str(data_dir / pattern), recursive=True))
-
-    return sorted(fits_files)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+log = logging.getLogger("ddte")
+
+# Linha separadora das seções do relatório
+SEPARATOR = '=' * 60
+
+# Máximo de eventos aceitos por imagem de ciência (os de maior SNR)
+MAX_CANDIDATES_PER_IMAGE = 100
+
+# Registro de um evento no buffer pré-alocado de main()
+EVENT_DTYPE = np.dtype([
+    ('snr', 'f8'), ('ra', 'f8'), ('dec', 'f8'), ('filter', 'U16'), ('science_image', 'U128')
+])
+
+
+# WCS já construídos, indexados pela impressão digital do header (as imagens alinhadas compartilham o mesmo)
+_WCS_CACHE = {}
+
+def _cached_wcs(header):
+    """WCS do header completo, construído uma vez por impressão digital distinta"""
+    key = align_images.wcs_fingerprint(header)
+    wcs = _WCS_CACHE.get(key)
+    if wcs is None:
+        wcs = _WCS_CACHE[key] = WCS(header)
+    return wcs
+
+def _buffered_write_fits(ccd, path):
+    """
+    Gravar um CCDData como FITS montando o arquivo em memória e escrevendo de uma só vez.
+
+    A escrita vai para um arquivo temporário no mesmo diretório, que só então
+    substitui o destino: uma execução interrompida nunca deixa um FITS truncado.
+    """
+    path = Path(path)
+    buffer = io.BytesIO()
+    ccd.to_hdu().writeto(buffer)
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        tmp_path.write_bytes(buffer.getbuffer())
+        os.replace(tmp_path, path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+def tiled_combine(filter_dir, files, tile=(combine_images.ROW_BAND, 1024)):
+    """
+    Combinar as imagens do filtro em blocos (tile) do plano da imagem, para que
+    a pilha em memória nunca passe de tile × N imagens.
+
+    Os arquivos são abertos uma única vez e os blocos são costurados num
+    np.memmap em arquivo temporário (removido quando o array deixa de ser
+    usado), em vez de num array alocado à parte.
+    """
+    header = fits.getheader(files[0])
+    height, width = header['NAXIS2'], header['NAXIS1']
+
+    combined = np.memmap(tempfile.TemporaryFile(dir=filter_dir, suffix='.tmp'),
+                         dtype=np.float32, mode='w+', shape=(height, width))
+    return combine_images.process(filter_dir, files=files, tile=tile, out=combined)
+
+def _fast_read_ccd(fits_file):
+    """
+    Ler uma imagem de ciência como CCDData em valores físicos.
+
+    Com o fitsio a leitura vai direto ao cfitsio numa única chamada; sem ele,
+    usa o astropy (memmap) aplicando a escala à mão.
+    """
+    if fitsio is not None:
+        data, fitsio_header = fitsio.read(str(fits_file), ext=0, header=True)
+        header = fits.Header([(r['name'], r['value']) for r in fitsio_header.records()
+                              if r['name'] not in ('COMMENT', 'HISTORY', '')])
+        data = data.astype(np.float32, copy=False)
+
+        # O fitsio aplica BSCALE/BZERO mas não troca BLANK por NaN
+        blank = header.get('BLANK')
+        if blank is not None:
+            blank_value = np.float32(blank * header.get('BSCALE', 1) + header.get('BZERO', 0))
+            data[data == blank_value] = np.nan
+    else:
+        with fits.open(fits_file, memmap=True, do_not_scale_image_data=True) as hdul:
+            header = hdul[0].header.copy()
+            data = io_utils.read_scaled(hdul[0])
+
+    for key in io_utils.SCALE_KEYWORDS:
+        header.pop(key, None)
+    return CCDData(data, unit=u.adu, meta=header)
+
+def load_science(fits_file):
+    """Carregar uma imagem de ciência com o WCS (reaproveitado do cache) fixado em .wcs"""
+    science_image = _fast_read_ccd(fits_file)
+    science_image.wcs = _cached_wcs(science_image.header)
+    return science_image
+
+# Referência combinada do filtro, vista sem cópia a partir da memória compartilhada
+REF_CCD = None
+_REF_SHM = None
+
+def _init_worker(shm_name, shape, dtype, n_threads):
+    """Inicializar o worker com uma view da referência combinada na memória compartilhada"""
+    global REF_CCD, _REF_SHM
+    # Os kernels numba do worker usam só a sua parte dos núcleos
+    numba.set_num_threads(n_threads)
+    _REF_SHM = shared_memory.SharedMemory(name=shm_name)
+    ref_data = np.ndarray(shape, dtype=dtype, buffer=_REF_SHM.buf)
+    # A detecção usa só os dados da referência; as coordenadas vêm do WCS da imagem de ciência
+    REF_CCD = CCDData(ref_data, unit=u.adu)
+
+def _process_one(fits_file, science_future, exact_stats):
+    """Detectar eventos numa imagem de ciência (já em leitura) contra a referência do worker"""
+    try:
+        science_image = science_future.result()
+        events = detect_events.process(
+            REF_CCD, science_image, exact_stats=exact_stats, science_wcs=science_image.wcs,
+            max_candidates=MAX_CANDIDATES_PER_IMAGE
+        )
+    except Exception as e:
+        return fits_file, None, None, e
+
+    return fits_file, science_image.header.get('EXPTIME', 'N/A'), events, None
+
+def _process_batch(fits_files, exact_stats):
+    """Processar um lote de imagens no worker, lendo a próxima numa thread enquanto a atual é analisada"""
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_image = reader.submit(load_science, fits_files[0])
+        for i, fits_file in enumerate(fits_files):
+            science_future = next_image
+            if i + 1 < len(fits_files):
+                next_image = reader.submit(load_science, fits_files[i + 1])
+            results.append(_process_one(fits_file, science_future, exact_stats))
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Detecção de eventos transitórios em imagens do ZTF")
+    parser.add_argument(
+        '--exact',
+        action='store_true',
+        help="Estimar o ruído da diferença com astropy.stats.sigma_clipped_stats em vez do MAD de uma amostra"
+    )
+    parser.add_argument(
+        '--force-recombine',
+        action='store_true',
+        help="Recalcular a referência combinada mesmo que a salva em disco esteja atualizada"
+    )
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     MAX_IMAGES = None # None para processar todas
     MAX_SCIENCE_IMAGES_PER_FILTER = 20  # Limite de imagens de ciência a processar por filtro
+    MAX_REFERENCE_IMAGES = 20  # Imagens usadas na referência combinada de cada filtro
 
     project_root = Path(__file__).parent.parent
     data_dir = project_root / "data"
 
-    fits_files = find_fits_files(data_dir)
+    fits_files = io_utils.find_fits_files(data_dir)
 
     if MAX_IMAGES is not None and len(fits_files) == 0:
-        print(f"\n❌ Nenhum arquivo FITS encontrado em {data_dir}")
+        log.error("\n❌ Nenhum arquivo FITS encontrado em %s", data_dir)
         return
 
     if MAX_IMAGES is not None and len(fits_files) > MAX_IMAGES:
@@ -38,110 +191,157 @@ def main():
     # output_dir = align_images.process(fits_files)
     output_dir = Path("/media/giuliano/Disco D/DDTE/output/aligned")
 
-    print(f"Output directory: {output_dir}")
+    log.info("Output directory: %s", output_dir)
 
     # Filtros disponíveis
     filters = ['ZTF_r']
 
-    all_events = []
+    # Eventos guardados num único buffer estruturado, pré-alocado para o pior
+    # caso (cada imagem limitada a MAX_CANDIDATES_PER_IMAGE eventos)
+    event_buf = np.empty(MAX_SCIENCE_IMAGES_PER_FILTER * MAX_CANDIDATES_PER_IMAGE * len(filters),
+                         dtype=EVENT_DTYPE)
+    cursor = 0
+    events_per_filter = collections.Counter()
 
     # Processar cada filtro separadamente
     for filter_name in filters:
         filter_dir = output_dir / filter_name
 
         if not filter_dir.exists():
-            print(f"\n⚠️  Diretório {filter_dir} não existe, pulando filtro {filter_name}")
+            log.warning("\n⚠️  Diretório %s não existe, pulando filtro %s", filter_dir, filter_name)
             continue
 
-        print(f"\n{'='*60}")
-        print(f"PROCESSANDO FILTRO: {filter_name}")
-        print(f"{'='*60}")
+        log.info("\n%s\nPROCESSANDO FILTRO: %s\n%s", SEPARATOR, filter_name, SEPARATOR)
 
         # Encontrar imagens deste filtro
-        filter_images = sorted(filter_dir.glob('*.fits'))
+        with os.scandir(filter_dir) as entries:
+            filter_images = sorted(
+                Path(entry.path) for entry in entries
+                if entry.is_file() and entry.name.endswith('.fits')
+            )
 
         if len(filter_images) == 0:
-            print(f"⚠️  Nenhuma imagem encontrada para o filtro {filter_name}")
+            log.warning("⚠️  Nenhuma imagem encontrada para o filtro %s", filter_name)
             continue
 
-        print(f"Encontradas {len(filter_images)} imagens no filtro {filter_name}")
+        log.info("Encontradas %d imagens no filtro %s", len(filter_images), filter_name)
+
+        # Imagens de ciência: todas exceto a própria referência combinada
+        science_candidates = [f for f in filter_images if not f.name.startswith('median_combined')]
 
         # Criar imagem de referência combinada apenas com imagens deste filtro
-        print(f"\nCriando imagem de referência combinada para {filter_name}...")
+        log.info("\nCriando imagem de referência combinada para %s...", filter_name)
+        reference_file = filter_dir / f"median_combined_{filter_name}.fits"
+        median_combined = None
+
+        # Reaproveitar a referência salva se ela for mais nova que todas as imagens do filtro
+        latest_input = max((f.stat().st_mtime for f in science_candidates), default=0)
+        if (not args.force_recombine and reference_file.exists()
+                and reference_file.stat().st_mtime > latest_input):
+            try:
+                median_combined = CCDData.read(reference_file, unit=u.adu)
+                log.info("✓ Referência combinada atualizada carregada de: %s", reference_file)
+            except Exception as e:
+                log.warning("⚠️  Referência salva ilegível (%s), recombinando", e)
+
         try:
-            median_combined = combine_images.process(filter_dir, max_images=20)
-            reference_file = filter_dir / f"median_combined_{filter_name}.fits"
-            median_combined.write(reference_file, overwrite=True)
-            print(f"✓ Referência combinada salva em: {reference_file}")
+            if median_combined is None:
+                median_combined = tiled_combine(filter_dir, science_candidates[:MAX_REFERENCE_IMAGES])
+                _buffered_write_fits(median_combined, reference_file)
+                log.info("✓ Referência combinada salva em: %s", reference_file)
         except Exception as e:
-            print(f"❌ Erro ao criar referência combinada: {e}")
+            log.error("❌ Erro ao criar referência combinada: %s", e)
             continue
 
-        # Processar cada imagem de ciência deste filtro
-        print(f"\nProcessando imagens de ciência do filtro {filter_name}...")
-        loop_count = 0
-
-        for fits_file in filter_images:
-            # Pular a própria imagem de referência combinada
-            if 'median_combined' in fits_file.name:
-                continue
-
-            print(f"\n[{loop_count + 1}] Processando {fits_file.name}")
-
-            try:
-                science_image = CCDData.read(fits_file, unit=u.adu)
-                print(f"  EXPTIME: {science_image.header.get('EXPTIME', 'N/A')}")
-
-                events = detect_events.process(median_combined, science_image)
-
-                # Adicionar informação do filtro aos eventos
-                for event in events:
-                    event['filter'] = filter_name
-                    event['science_image'] = fits_file.name
-
-                all_events.extend(events)
-                print(f"  ✓ Encontrados {len(events)} eventos nesta imagem")
-
-                # Limpar imagem da memória após processar
-                del science_image
-
-                # Forçar garbage collection a cada 10 imagens
-                loop_count += 1
-                if loop_count % 10 == 0:
-                    gc.collect()
-
-                if loop_count >= MAX_SCIENCE_IMAGES_PER_FILTER:
-                    print(f"  ⚠️  Limite de {MAX_SCIENCE_IMAGES_PER_FILTER} imagens atingido para este filtro")
-                    break
-
-            except Exception as e:
-                print(f"  ❌ Erro ao processar {fits_file.name}: {e}")
+        # Processar as imagens de ciência deste filtro, até o limite
+        log.info("\nProcessando imagens de ciência do filtro %s...", filter_name)
+        science_images = science_candidates[:MAX_SCIENCE_IMAGES_PER_FILTER]
+        if len(science_candidates) > MAX_SCIENCE_IMAGES_PER_FILTER:
+            log.warning("  ⚠️  Limite de %d imagens atingido para este filtro", MAX_SCIENCE_IMAGES_PER_FILTER)
+
+        # As imagens são independentes entre si: cada uma roda num worker. A
+        # referência é copiada uma vez para memória compartilhada e os workers
+        # recebem só o nome, o shape e o dtype do bloco
+        ref_data = median_combined.data
+
+        # A referência lida do disco vem big-endian (>f4): o bloco compartilhado
+        # fica na ordem nativa para os kernels numba não precisarem convertê-la
+        ref_dtype = ref_data.dtype.newbyteorder('=')
+        shm = shared_memory.SharedMemory(create=True, size=ref_data.nbytes)
+        try:
+            np.ndarray(ref_data.shape, dtype=ref_dtype, buffer=shm.buf)[:] = ref_data
+            # Cada worker recebe um lote contíguo de imagens, para que a leitura
+            # da próxima se sobreponha à detecção da atual; os núcleos são
+            # divididos entre os workers e as threads numba de cada um
+            n_cpus = os.cpu_count() or 1
+            n_workers = max(1, min(n_cpus, len(science_images)))
+            n_threads = max(1, n_cpus // n_workers)
+            batch_size = max(1, -(-len(science_images) // n_workers))
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_init_worker,
+                initargs=(shm.name, ref_data.shape, ref_dtype.str, n_threads)
+            ) as pool:
+                batches = [science_images[i:i + batch_size] for i in range(0, len(science_images), batch_size)]
+                futures = [pool.submit(_process_batch, batch, args.exact) for batch in batches]
+
+                # Resultados na ordem de entrada; um worker que morre (ex.: OOM)
+                # só marca as imagens do seu lote como erro
+                results = []
+                for batch, future in zip(batches, futures):
+                    try:
+                        results.extend(future.result())
+                    except Exception as e:
+                        results.extend((fits_file, None, None, e) for fits_file in batch)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        for loop_count, (fits_file, exptime, events, error) in enumerate(results, 1):
+            log.info("\n[%d] Processando %s", loop_count, fits_file.name)
+
+            if error is not None:
+                log.error("  ❌ Erro ao processar %s: %s", fits_file.name, error)
                 continue
 
-        # Limpar referência combinada da memória após processar todas as imagens do filtro
-        del median_combined
-        gc.collect()
-
-        print(f"\n✓ Filtro {filter_name} processado: {loop_count} imagens, {len([e for e in all_events if e.get('filter') == filter_name])} eventos totais")
+            log.info("  EXPTIME: %s", exptime)
+            # A maioria das imagens não tem eventos: só preenche o buffer quando há
+            if events:
+                block = event_buf[cursor:cursor + len(events)]
+                block['snr'] = [event['snr'] for event in events]
+                block['ra'] = [event['ra'] for event in events]
+                block['dec'] = [event['dec'] for event in events]
+                block['filter'] = filter_name
+                block['science_image'] = fits_file.name
+                cursor += len(events)
+                events_per_filter[filter_name] += len(events)
+            log.info("  ✓ Encontrados %d eventos nesta imagem", len(events))
+
+        processed = sum(error is None for *_, error in results)
+        log.info("\n✓ Filtro %s processado: %d imagens, %d eventos totais",
+                 filter_name, processed, events_per_filter[filter_name])
 
     # Resumo final
-    print(f"\n{'='*60}")
-    print(f"RESUMO FINAL")
-    print(f"{'='*60}")
-    print(f"Total de eventos encontrados: {len(all_events)}")
+    log.info("\n%s\nRESUMO FINAL\n%s", SEPARATOR, SEPARATOR)
+    found = event_buf[:cursor]
+    snr, ra, dec, filter_arr = found['snr'], found['ra'], found['dec'], found['filter']
+    log.info("Total de eventos encontrados: %d", len(snr))
 
     # Estatísticas por filtro
     for filter_name in filters:
-        filter_events = [e for e in all_events if e.get('filter') == filter_name]
-        print(f"  {filter_name}: {len(filter_events)} eventos")
-
-    # Ordenar todos os eventos por SNR (maior primeiro)
-    all_events.sort(key=lambda x: x.get('snr', 0), reverse=True)
-
-    print(f"\nTop 10 eventos (por SNR):")
-    for i, event in enumerate(all_events[:10], 1):
-        print(f"  {i}. SNR={event.get('snr', 0):.2f}, Filter={event.get('filter', 'N/A')}, "
-              f"RA={event.get('ra', 0):.6f}, DEC={event.get('dec', 0):.6f}")
+        log.info("  %s: %d eventos", filter_name, events_per_filter[filter_name])
+
+    # Só os 10 maiores SNR precisam ser ordenados (maior primeiro)
+    if len(snr) > 10:
+        top = np.argpartition(-snr, 9)[:10]
+    else:
+        top = np.arange(len(snr))
+    top = top[np.argsort(-snr[top])]
+
+    log.info("\nTop 10 eventos (por SNR):")
+    for i, idx in enumerate(top, 1):
+        log.info("  %d. SNR=%.2f, Filter=%s, RA=%.6f, DEC=%.6f",
+                 i, snr[idx], filter_arr[idx], ra[idx], dec[idx])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
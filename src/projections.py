@@ -0,0 +1,66 @@
+"""
+Projeção gnomônica (TAN) vetorizada com NumPy, para converter pixel <-> céu
+sem passar pelo WCSLIB quando o WCS é um TAN puro (sem SIP/distorções)
+"""
+
+import numpy as np
+
+
+def is_pure_tan(wcs):
+    """Verificar se o WCS é um RA---TAN/DEC--TAN linear, sem termos de distorção"""
+    return (
+        wcs.naxis == 2
+        and list(wcs.wcs.ctype) == ['RA---TAN', 'DEC--TAN']
+        and wcs.sip is None
+        and wcs.cpdis1 is None and wcs.cpdis2 is None
+        and wcs.det2im1 is None and wcs.det2im2 is None
+        and len(wcs.wcs.get_pv()) == 0
+        and wcs.wcs.lonpole == 180
+    )
+
+
+def tan_parameters(wcs):
+    """Extrair (crpix, crval, cdelt, pc) de um WCS TAN puro"""
+    return wcs.wcs.crpix, wcs.wcs.crval, wcs.wcs.get_cdelt(), wcs.wcs.get_pc()
+
+
+def manual_pix_to_world_tan(x, y, crpix, crval, cdelt, pc):
+    """Converter pixels (base 0) em (RA, Dec) em graus para uma projeção TAN"""
+    # Pixel relativo ao CRPIX (que no FITS é base 1)
+    dx = x + 1 - crpix[0]
+    dy = y + 1 - crpix[1]
+
+    # Coordenadas intermediárias no plano de projeção, em radianos
+    xi = np.deg2rad(cdelt[0] * (pc[0, 0] * dx + pc[0, 1] * dy))
+    eta = np.deg2rad(cdelt[1] * (pc[1, 0] * dx + pc[1, 1] * dy))
+
+    # Projeção gnomônica inversa em torno de (CRVAL1, CRVAL2)
+    ra0, dec0 = np.deg2rad(crval)
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.sqrt(xi * xi + denom * denom))
+
+    return np.rad2deg(ra) % 360, np.rad2deg(dec)
+
+
+def manual_world_to_pix_tan(ra, dec, crpix, crval, cdelt, pc):
+    """Converter (RA, Dec) em graus em pixels (base 0) para uma projeção TAN"""
+    ra0, dec0 = np.deg2rad(crval)
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+
+    # Projeção gnomônica direta
+    cos_dra = np.cos(ra - ra0)
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * cos_dra
+    # Pontos no hemisfério oposto ao centro da projeção não têm pixel
+    cos_c = np.where(cos_c > 0, cos_c, np.nan)
+
+    xi = np.rad2deg(np.cos(dec) * np.sin(ra - ra0) / cos_c) / cdelt[0]
+    eta = np.rad2deg((np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * cos_dra) / cos_c) / cdelt[1]
+
+    # Desfazer a matriz PC
+    inv_pc = np.linalg.inv(pc)
+    x = inv_pc[0, 0] * xi + inv_pc[0, 1] * eta + crpix[0] - 1
+    y = inv_pc[1, 0] * xi + inv_pc[1, 1] * eta + crpix[1] - 1
+
+    return x, y